@@ -2,7 +2,7 @@ import torch
 from IPython.display import Audio
 from datasets import load_dataset
 from encodec import EncodecModel
-from transformers import AutoTokenizer
+from transformers import AutoTokenizer, LogitsProcessor, LogitsProcessorList
 
 from encodec_bart_model import BartEncodecForConditionalGeneration
 
@@ -12,50 +12,72 @@ tokenizer = AutoTokenizer.from_pretrained("voidful/bart-base-unit")
 model = BartEncodecForConditionalGeneration.from_pretrained("./checkpoint-45356/")
 model.config.forced_bos_token_id = None
 model = model.to('cuda')
+encodec_model = EncodecModel.encodec_model_24khz()
+encodec_model.set_target_bandwidth(6.0)
+encodec_model = encodec_model.to('cuda').eval()
+
+# v_tok_* ids are contiguous in the vocab, so unit -> token id is a constant shift per layer
+V_TOK_BASE = tokenizer.convert_tokens_to_ids('v_tok_0')
+assert tokenizer.convert_tokens_to_ids('v_tok_8191') == V_TOK_BASE + 8191, "v_tok_* ids are not contiguous"
+
+
+def encodec_to_ids(units, layer=0):
+    return (torch.tensor(units) + V_TOK_BASE + layer * 1024).unsqueeze(0).to('cuda')
+
+
+class BanRangeLogitsProcessor(LogitsProcessor):
+    """Bans the contiguous token id range [lo, hi) with a single slice fill."""
+
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+
+    def __call__(self, input_ids, scores):
+        scores[:, self.lo:self.hi] = -float("inf")
+        return scores
+
 
 inputs = tokenizer(dataset["text"][0],
-                   padding="max_length",
+                   padding="longest",
                    truncation=True,
                    max_length=1024,
                    return_tensors="pt").to('cuda')
 
-encode_input = tokenizer(tokenizer.convert_ids_to_tokens(model.config.decoder_start_token_id) +"".join([f"v_tok_{u}" for u in dataset[f'encodec_0'][0]]),return_tensors='pt',add_special_tokens=False).to('cuda')
-encode_input = encode_input['input_ids']
+encode_input = torch.cat([torch.tensor([[model.config.decoder_start_token_id]], device='cuda'),
+                          encodec_to_ids(dataset[f'encodec_0'][0])], dim=-1)
 inputs['decoder_input_ids'] = encode_input[:,:50]
 
-bad_words_ids = [[tokenizer.convert_tokens_to_ids(f'v_tok_{i}')] for i in range(1025,1024*8)]
-
-decode_ar = model.generate(**inputs,max_length=1024, num_beams=1, do_sample=True, use_cache=True, bad_words_ids=bad_words_ids)
+# AR decoding emits layer-0 units (v_tok_0 .. v_tok_1023), ban the layer 1-7 ids v_tok_1024 .. v_tok_8191
+logits_processor = LogitsProcessorList([BanRangeLogitsProcessor(V_TOK_BASE + 1024, V_TOK_BASE + 1024 * 8)])
+
+# the AR pass and every NAR layer share the same text input, so run the encoder once and reuse its output
+with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.bfloat16):
+    encoder_outputs = model.get_encoder()(input_ids=inputs['input_ids'], attention_mask=inputs['attention_mask'])
+    decode_ar = model.generate(encoder_outputs=encoder_outputs,
+                               attention_mask=inputs['attention_mask'],
+                               decoder_input_ids=inputs['decoder_input_ids'],
+                               max_length=1024, num_beams=1, do_sample=True, use_cache=True,
+                               logits_processor=logits_processor)
 decoded_tok = tokenizer.batch_decode(decode_ar, skip_special_tokens=True)[0]
 
-def nar_decode(batch_code, layer=0):
-    base_input = inputs
-    base_input['decoder_input_ids'] = batch_code
-    decode_nar = model.forward(**base_input).logits
-
-    id_range_start, id_range_end = tokenizer.convert_tokens_to_ids(
-        f'v_tok_{0 + 1024 * layer}'), tokenizer.convert_tokens_to_ids(f'v_tok_{1024 + 1024 * layer}')
-
-    # Create a tensor where values are equal to their own indices
-    indices = torch.arange(decode_nar.size(-1)).to(decode_nar.device)
 
-    # Create a mask for the range
-    mask = (indices >= id_range_start) & (indices < id_range_end)
+@torch.inference_mode()
+@torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+def nar_decode(batch_code, layer=0):
+    decode_nar = model.forward(encoder_outputs=encoder_outputs,
+                               attention_mask=inputs['attention_mask'],
+                               decoder_input_ids=batch_code).logits
 
-    # Set values out of range to very low value
-    decode_nar_masked = torch.where(mask, decode_nar, torch.tensor(float('-inf')).to(decode_nar.device))
+    id_range_start, id_range_end = V_TOK_BASE + 1024 * layer, V_TOK_BASE + 1024 * (layer + 1)
 
-    # Get the argmax within the range
-    return torch.argmax(decode_nar_masked, dim=-1)
+    # Get the argmax within this layer's contiguous v_tok range
+    return torch.argmax(decode_nar[..., id_range_start:id_range_end], dim=-1) + id_range_start
 
 
 # all ground truth unit
 layer_list = []
 for layer_i in range(8):
-    encode_input = tokenizer("".join([f"v_tok_{u + layer_i * 1024}" for u in dataset[f'encodec_{layer_i}'][0]]),
-                             return_tensors='pt', add_special_tokens=False).to('cuda')
-    encode_input = encode_input['input_ids']
-    layer_list.append(encode_input)
+    layer_list.append(encodec_to_ids(dataset[f'encodec_{layer_i}'][0], layer_i))
 
 # using model prediction
 
@@ -66,10 +88,7 @@ layer_list.append(decode_ar[:, 1:-1])
 
 # use ground truth ar prediction
 layer_i = 0
-encode_input = tokenizer("".join([f"v_tok_{u + layer_i * 1024}" for u in dataset[f'encodec_{layer_i}'][0]]),
-                         return_tensors='pt', add_special_tokens=False).to('cuda')
-encode_input = encode_input['input_ids']
-layer_list.append(encode_input)
+layer_list.append(encodec_to_ids(dataset[f'encodec_{layer_i}'][0], layer_i))
 
 # iterative predict nar code
 for layer in range(1, 8):
@@ -77,12 +96,12 @@ for layer in range(1, 8):
 
 # covert ar+nar code into encodec code
 encodec_code = []
-for layer, layer_ids in enumerate(tokenizer.batch_decode(torch.cat(layer_list))):
-    layer_ids = layer_ids.replace("</s>", "")
-    encodec_code.append([int(i) - layer * 1024 for i in layer_ids.split('v_tok_') if len(i) > 0])
-
-encodec_model = EncodecModel.encodec_model_24khz()
-encodec_model.set_target_bandwidth(6.0)
+for layer, layer_ids in enumerate(torch.cat(layer_list)):
+    # drop </s> and <pad>, then undo the per-layer offset
+    layer_ids = layer_ids[(layer_ids != tokenizer.eos_token_id) & (layer_ids != tokenizer.pad_token_id)]
+    encodec_code.append((layer_ids - V_TOK_BASE - layer * 1024).tolist())
 
 # synthesize audio
-Audio(encodec_model.decode([(torch.tensor(encodec_code).unsqueeze(0).to('cpu'), None)]).detach().numpy()[0], rate=24000)
+with torch.inference_mode():
+    audio = encodec_model.decode([(torch.tensor(encodec_code).unsqueeze(0).to('cuda'), None)])
+Audio(audio.cpu().numpy()[0], rate=24000)
@@ -1,3 +1,6 @@
+import os
+
+import numpy as np
 from datasets import load_dataset
 from jiwer import wer
 from transformers import (
@@ -9,11 +12,19 @@ from transformers import (
 
 from encodec_bart_model import BartEncodecForConditionalGeneration
 
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
 # Load dataset and tokenizer
 dataset = load_dataset("voidful/librispeech_encodec")
 tokenizer = AutoTokenizer.from_pretrained("voidful/bart-base-unit")
 model = BartEncodecForConditionalGeneration.from_pretrained("voidful/bart-base-unit")
 
+# v_tok id for each (encodec level, unit)
+VTOK = np.array([tokenizer.convert_tokens_to_ids([f"v_tok_{u + i * 1024}" for u in range(1024)]) for i in range(8)],
+                dtype=np.int32)
+# pad token id for the encodec inputs and label masking
+PAD_TOKEN_ID = tokenizer.pad_token_id
+
 # Split the dataset into training and validation sets
 
 train_dataset = dataset['trainclean100']
@@ -38,7 +49,10 @@ training_args = Seq2SeqTrainingArguments(
     weight_decay=0,
     predict_with_generate=True,
     generation_max_length=300,
-    fp16=True,
+    bf16=True,
+    tf32=True,
+    torch_compile=True,
+    torch_compile_backend="inductor",
     save_total_limit=3,
 )
 
@@ -51,55 +65,48 @@ def process_data_to_model_inputs(batch):
     max_len = 1023
     labels = tokenizer(batch["text"], padding=True, truncation=True, max_length=max_len).input_ids
     # Replace pad_token_id (0) with -100
-    labels = [[-100 if token_id == tokenizer.pad_token_id else token_id for token_id in seq] for seq in labels]
+    labels = [[-100 if token_id == PAD_TOKEN_ID else token_id for token_id in seq] for seq in labels]
     batch["labels"] = labels
 
-    input_datas = []
+    # Pad the 8 encodec levels into one (batch, 8, max_len) array and create attention masks
+    padded_input_datas = np.full((len(batch['text']), 8, max_len), PAD_TOKEN_ID, dtype=np.int32)
+    attention_masks = np.zeros((len(batch['text']), max_len), dtype=np.int8)
     for b in range(len(batch['text'])):
-        encodec_input = []
         for i in range(8):
-            encodec_input.append(
-                tokenizer.convert_tokens_to_ids([f"v_tok_{u + i * 1024}" for u in batch[f'encodec_{i}'][b]]))
-        input_datas.append(encodec_input)
-    # Pad the input data sequences and create attention masks
-    padded_input_datas = []
-    attention_masks = []
-    for input_data in input_datas:
-        padded_input_data = []
-        for seq in input_data:
-            seq_len = len(seq)
-            padded_seq = seq + [tokenizer.pad_token_id] * (max_len - seq_len)
-            mask = [1] * seq_len + [0] * (max_len - seq_len)
-            padded_input_data.append(padded_seq)
-        padded_input_datas.append(padded_input_data)
-        attention_masks.append(mask)
+            seq = batch[f'encodec_{i}'][b]
+            padded_input_datas[b, i, :len(seq)] = VTOK[i, seq]
+        attention_masks[b, :len(batch['encodec_0'][b])] = 1
     batch["input_ids"] = padded_input_datas
     batch["attention_mask"] = attention_masks
     return batch
 
 
-def filter_examples(example):
-    return len(example[f"encodec_0"]) <= 1000
+def filter_examples(batch):
+    return [len(encodec) <= 1000 for encodec in batch["encodec_0"]]
 
 
-train_dataset = train_dataset.filter(filter_examples)
-valid_dataset = valid_dataset.filter(filter_examples)
+train_dataset = train_dataset.filter(filter_examples, batched=True, num_proc=os.cpu_count())
+valid_dataset = valid_dataset.filter(filter_examples, batched=True, num_proc=os.cpu_count())
 
 train_dataset = train_dataset.map(
     process_data_to_model_inputs,
     batched=True,
+    num_proc=os.cpu_count(),
     batch_size=training_args.per_device_train_batch_size
 )
 valid_dataset = valid_dataset.map(
     process_data_to_model_inputs,
     batched=True,
+    num_proc=os.cpu_count(),
     batch_size=training_args.per_device_eval_batch_size
 )
 
 
 def compute_metrics(eval_pred):
     predictions, labels = eval_pred
-    labels = [i[i != -100] for i in labels]
+    # -100 -> pad so batch_decode can skip it
+    labels = np.where(labels != -100, labels, PAD_TOKEN_ID)
+    predictions = np.where(predictions != -100, predictions, PAD_TOKEN_ID)
     decoded_preds = tokenizer.batch_decode(predictions, skip_special_tokens=True)
     decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
 
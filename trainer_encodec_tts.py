@@ -1,4 +1,11 @@
-from datasets import load_dataset
+import hashlib
+import inspect
+import json
+import os
+import shutil
+
+import numpy as np
+from datasets import DatasetDict, load_dataset, load_from_disk
 from jiwer import wer
 from transformers import (
     AutoTokenizer,
@@ -9,9 +16,26 @@ from transformers import (
 # Load dataset and tokenizer
 from encodec_bart_model import BartEncodecForConditionalGeneration
 
-dataset = load_dataset("voidful/librispeech_encodec")
-tokenizer = AutoTokenizer.from_pretrained("voidful/bart-base-unit")
-model = BartEncodecForConditionalGeneration.from_pretrained("voidful/bart-base-unit")
+os.environ["TOKENIZERS_PARALLELISM"] = "false"
+
+DATASET_NAME = "voidful/librispeech_encodec"
+TOKENIZER_NAME = "voidful/bart-base-unit"
+MODEL_NAME = "voidful/bart-base-unit"
+
+dataset = load_dataset(DATASET_NAME)
+tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+model = BartEncodecForConditionalGeneration.from_pretrained(MODEL_NAME)
+
+# v_tok id for each (encodec level, unit)
+VTOK = np.array([tokenizer.convert_tokens_to_ids([f"v_tok_{u + i * 1024}" for u in range(1024)]) for i in range(8)],
+                dtype=np.int32)
+# special token ids for the decoder inputs and labels
+DECODER_START_TOKEN_ID = model.config.decoder_start_token_id
+EOS_TOKEN_ID = tokenizer.eos_token_id
+PAD_TOKEN_ID = tokenizer.pad_token_id
+
+MAX_LENGTH = 1023  # You can set this to a suitable value based on your dataset
+MAX_ENCODEC_LENGTH = 1000
 
 # Split the dataset into training and validation sets
 train_dataset = dataset['trainclean100']
@@ -32,7 +56,11 @@ training_args = Seq2SeqTrainingArguments(
     save_total_limit=10,
     predict_with_generate=True,
     learning_rate=5e-4,
-    fp16=True,
+    bf16=True,
+    tf32=True,
+    torch_compile=True,
+    torch_compile_backend="inductor",
+    torch_compile_mode="reduce-overhead",
     gradient_accumulation_steps=2
 )
 data_collator = DataCollatorWithPadding(tokenizer)
@@ -45,38 +73,40 @@ def process_data_to_model_inputs(batch):
     decoder_input_ids = []
     labels = []
 
-    max_length = 1023  # You can set this to a suitable value based on your dataset
+    max_length = MAX_LENGTH
 
+    text_data = tokenizer(batch["text"], padding='max_length', truncation=True, max_length=max_length)
     for b in range(len(batch['text'])):
-        data = tokenizer(batch["text"][b], padding='max_length', truncation=True, max_length=max_length)
-        input_ids.append(data['input_ids'])
-        attention_mask.append(data['attention_mask'])
+        input_ids.append(text_data['input_ids'][b])
+        attention_mask.append(text_data['attention_mask'][b])
 
         # first layer AR data
-        encode_input = tokenizer.convert_tokens_to_ids([f"v_tok_{u}" for u in batch[f'encodec_{0}'][b]])
-        decoder_input_id = [model.config.decoder_start_token_id] + encode_input
-        label = encode_input + [tokenizer.eos_token_id]
+        encode_input = VTOK[0, batch[f'encodec_{0}'][b]].tolist()
+        decoder_input_id = [DECODER_START_TOKEN_ID] + encode_input
+        label = encode_input + [EOS_TOKEN_ID]
         decoder_input_ids.append(decoder_input_id)
         labels.append(label)
 
         # 1-7 layer NAR data
         for i in range(1, 8):
-            decoder_input_id = tokenizer.convert_tokens_to_ids(
-                [f"v_tok_{u + (i - 1) * 1024}" for u in batch[f'encodec_{i - 1}'][b]])
-            label = tokenizer.convert_tokens_to_ids([f"v_tok_{u + i * 1024}" for u in batch[f'encodec_{i}'][b]])
-            input_ids.append(data['input_ids'])
-            attention_mask.append(data['attention_mask'])
+            decoder_input_id = VTOK[i - 1, batch[f'encodec_{i - 1}'][b]].tolist()
+            label = VTOK[i, batch[f'encodec_{i}'][b]].tolist()
+            input_ids.append(text_data['input_ids'][b])
+            attention_mask.append(text_data['attention_mask'][b])
             decoder_input_ids.append(decoder_input_id)
             labels.append(label)
 
     def pad_sequences_and_create_masks(sequences, max_length, padding_value):
-        padded_sequences = [sequence + [padding_value] * (max_length - len(sequence)) for sequence in sequences]
-        attention_masks = [[1 if token != padding_value else 0 for token in sequence] for sequence in padded_sequences]
+        padded_sequences = np.full((len(sequences), max_length), padding_value, dtype=np.int32)
+        attention_masks = np.zeros((len(sequences), max_length), dtype=np.int8)
+        for i, sequence in enumerate(sequences):
+            padded_sequences[i, :len(sequence)] = sequence
+            attention_masks[i, :len(sequence)] = 1
         return padded_sequences, attention_masks
 
     # Pad decoder_input_ids and labels
     decoder_input_ids, decoder_attention_mask = pad_sequences_and_create_masks(decoder_input_ids, max_length=max_length,
-                                                                               padding_value=tokenizer.pad_token_id)
+                                                                               padding_value=PAD_TOKEN_ID)
     labels, _ = pad_sequences_and_create_masks(labels, max_length=max_length, padding_value=-100)
 
     return {
@@ -88,41 +118,75 @@ def process_data_to_model_inputs(batch):
     }
 
 
-def filter_examples(example):
-    return len(example[f"encodec_0"]) <= 1000
+def filter_examples(batch):
+    return [len(encodec) <= MAX_ENCODEC_LENGTH for encodec in batch["encodec_0"]]
+
+
+# Reuse the preprocessed splits across launches; the dir name is a hash of everything the splits depend on,
+# including the preprocessing code itself. Set FORCE_MAP=1 to ignore the cache and re-run filter + map.
+processed_config = {
+    "dataset": DATASET_NAME,
+    "tokenizer": TOKENIZER_NAME,
+    "model": MODEL_NAME,
+    "max_length": MAX_LENGTH,
+    "max_encodec_length": MAX_ENCODEC_LENGTH,
+    "vtok": hashlib.sha1(VTOK.tobytes()).hexdigest(),
+    "special_ids": [DECODER_START_TOKEN_ID, EOS_TOKEN_ID, PAD_TOKEN_ID],
+    "process_data_to_model_inputs": inspect.getsource(process_data_to_model_inputs),
+    "filter_examples": inspect.getsource(filter_examples),
+}
+processed_dir = "./processed_tts_" + hashlib.sha1(json.dumps(processed_config, sort_keys=True).encode()).hexdigest()[:8]
+is_local_main_process = training_args.local_process_index == 0
+force_map = os.environ.get("FORCE_MAP", "0") == "1" and is_local_main_process
+# The main process builds and saves the cache first; the other ranks then load it from disk
+with training_args.main_process_first(desc="tts preprocessing"):
+    if os.path.isdir(processed_dir) and not force_map:
+        processed_dataset = load_from_disk(processed_dir)
+        train_dataset, valid_dataset = processed_dataset['train'], processed_dataset['valid']
+    else:
+        train_dataset = train_dataset.filter(filter_examples, batched=True, num_proc=os.cpu_count())
+        valid_dataset = valid_dataset.filter(filter_examples, batched=True, num_proc=os.cpu_count())
+
+        train_dataset = train_dataset.map(
+            process_data_to_model_inputs,
+            remove_columns=train_dataset.column_names,
+            batched=True,
+            num_proc=os.cpu_count(),
+            batch_size=training_args.per_device_train_batch_size
+        )
+        valid_dataset = valid_dataset.map(process_data_to_model_inputs,
+                                          remove_columns=valid_dataset.column_names,
+                                          batched=True,
+                                          num_proc=os.cpu_count(),
+                                          batch_size=training_args.per_device_eval_batch_size
+                                          )
+        if is_local_main_process:
+            # Save to a temp dir and rename once complete, so a crash never leaves a partial cache
+            tmp_processed_dir = processed_dir + ".tmp"
+            shutil.rmtree(tmp_processed_dir, ignore_errors=True)
+            DatasetDict({'train': train_dataset, 'valid': valid_dataset}).save_to_disk(tmp_processed_dir)
+            shutil.rmtree(processed_dir, ignore_errors=True)
+            os.rename(tmp_processed_dir, processed_dir)
 
-
-train_dataset = train_dataset.filter(filter_examples)
-valid_dataset = valid_dataset.filter(filter_examples)
-
-train_dataset = train_dataset.map(
-    process_data_to_model_inputs,
-    remove_columns=train_dataset.column_names,
-    batched=True,
-    batch_size=training_args.per_device_train_batch_size
-)
-valid_dataset = valid_dataset.map(process_data_to_model_inputs,
-                                  remove_columns=valid_dataset.column_names,
-                                  batched=True,
-                                  batch_size=training_args.per_device_eval_batch_size
-                                  )
 train_dataset = train_dataset.shuffle(seed=42)
 
 
 def compute_metrics(eval_pred):
     predictions, labels = eval_pred
-    labels = [i[i != -100] for i in labels]
+    # -100 -> pad so batch_decode can skip it
+    labels = np.where(labels != -100, labels, PAD_TOKEN_ID)
+    predictions = np.where(predictions != -100, predictions, PAD_TOKEN_ID)
     decoded_preds = tokenizer.batch_decode(predictions, skip_special_tokens=True)
     decoded_labels = tokenizer.batch_decode(labels, skip_special_tokens=True)
 
     # Compute WER
-    wer_value = wer([" ".join(filter(None, i.split("v_tok_"))) for i in decoded_labels],
-                    [" ".join(filter(None, i.split("v_tok_"))) for i in decoded_preds])
+    wer_value = wer([i.replace("v_tok_", " ").strip() for i in decoded_labels],
+                    [i.replace("v_tok_", " ").strip() for i in decoded_preds])
     print("pred_result")
     print("=================================")
     for i in range(10):
-        print("target:" + labels[i])
-        print("pred:" + predictions[i])
+        print("target:" + decoded_labels[i])
+        print("pred:" + decoded_preds[i])
         print("-----------------")
     print("=================================")
     return {"wer": wer_value}